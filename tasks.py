@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
 # -*- coding: utf-8 -*-
+import functools
+import glob
+import hashlib
 import os
-import re
-from datetime import datetime, timedelta
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from typing import TYPE_CHECKING, Any, Optional
 
-import structlog
 from invoke.collection import Collection
 from invoke.exceptions import Exit
 from invoke.tasks import task
@@ -14,12 +18,14 @@ from invoke.tasks import task
 from utils import (
     get_target_config,
     join_path,
+    subprocess_run_stdout,
 )
 
 if TYPE_CHECKING:
     from invoke.context import Context
+    from structlog.typing import FilteringBoundLogger
 
-log = structlog.get_logger()
+    from utils import TargetConfig
 
 
 # Constants
@@ -28,13 +34,34 @@ ROOT_IMAGE = "ubuntu:22.04"
 
 PROJECT_ROOT = os.path.dirname(__file__)
 OUTPUT_DIR = join_path(PROJECT_ROOT, "output")
-OVERLAY_DIR = join_path(PROJECT_ROOT, "overlay")
+OVERLAY_DIR_NAME = "overlay"
+OVERLAY_DIR = join_path(PROJECT_ROOT, OVERLAY_DIR_NAME)
 DOCKERFILE_DIR = join_path(PROJECT_ROOT, "docker")
 
+UID = os.getuid()
+GID = os.getgid()
+
 DEFAULT_MAX_AGE = 3
+
+# Optional registry repository for sharing image build cache, e.g. in CI.
+#
+# With Docker, exporting the cache to a registry requires the containerd
+# image store or a buildx builder with other than the default 'docker'
+# driver; otherwise the cache is only imported. Note that a 'docker-container'
+# builder cannot use the locally built base image as the base of the
+# imagebuilder image, so the containerd image store is the working option.
+DOCKER_CACHE_REPO = os.environ.get("DOCKER_CACHE_REPO")
+DOCKER_CACHE_TAG = os.environ.get("DOCKER_CACHE_TAG", "latest")
+
+# Running in CI, no interactive terminal.
+CI = os.environ.get("CI", "").lower() in ("1", "true", "yes")
 DEFAULT_CONF = "default.conf"
+BUILD_DIGEST_FILE = ".build-digest"
 
 
+# Dockerfiles are built with BuildKit, so package downloads in them can use
+# cache mounts, e.g. 'RUN --mount=type=cache,target=/var/cache/apt ...', to
+# keep the downloads between image rebuilds.
 OPENWRT_BASE_IMAGE = "openwrt/base"
 OPENWRT_BASE_DOCKERFILE = "Dockerfile.base"
 
@@ -42,13 +69,54 @@ IMAGEBUILDER_DOCKERFILE = "Dockerfile.imagebuilder"
 IMAGEBUILDER_IMAGE_NAME = "openwrt-imagebuilder"
 IMAGEBUILDER_WORKDIR_ROOT = "/builder"
 IMAGEBUILDER_WORKDIR = f"{IMAGEBUILDER_WORKDIR_ROOT}/imagebuilder"
+IMAGEBUILDER_OVERLAY_DIR = f"{IMAGEBUILDER_WORKDIR_ROOT}/{OVERLAY_DIR_NAME}"
 IMAGEBUILDER_USER = "buildbot"
 
+# Platform-specific bind mount parameters.
+MOUNT_PARAM_FORMATS = {
+    "podman": "--mount=type=bind,src={src},dst={dst},relabel=shared",
+    "docker": "--mount=type=bind,source={src},destination={dst}",
+}
+
+# Characters of an image name replaced with '-' in the container hostname.
+HOSTNAME_TRANS = str.maketrans("\\/._", "----")
+
+# Image label holding the digest of the image build inputs.
+BUILD_DIGEST_LABEL = "build.digest"
+
+# Platform-specific environment for image build commands. The Dockerfiles
+# require BuildKit, which is not the default on older Docker versions.
+IMGBUILD_ENV = {
+    "podman": {},
+    "docker": {"DOCKER_BUILDKIT": "1"},
+}
+
+# Platform-specific image ID, creation time and build digest query formats.
+# Docker reports the creation time as RFC 3339 string, Podman as time value
+# which can be formatted as POSIX timestamp directly.
+_BUILD_DIGEST_FORMAT = '{{index .Config.Labels "' + BUILD_DIGEST_LABEL + '"}}'
+IMAGE_INFO_FORMATS = {
+    "podman": "{{.Id}}|{{.Created.Unix}}|" + _BUILD_DIGEST_FORMAT,
+    "docker": "{{.Id}}|{{.Created}}|" + _BUILD_DIGEST_FORMAT,
+}
+
+# Container image info by platform and image name, see `check_image_info`.
+_IMAGE_INFO_CACHE: dict[tuple[str, str], Optional[tuple[str, datetime, str]]] = {}
+
 ###############################################################################
 ## Utilities
 ###############################################################################
 
 
+@functools.cache
+def _log() -> "FilteringBoundLogger":
+    # Import structlog only when something is logged, so that listing the
+    # tasks does not pay for the import.
+    import structlog
+
+    return structlog.get_logger()
+
+
 def check_create_dir(path: str) -> None:
     """
     Check that specified directory exists, create if necessary.
@@ -56,8 +124,45 @@ def check_create_dir(path: str) -> None:
     :param path: Path, defaults to None
     :type path: str
     """
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
+
+
+@functools.cache
+def get_container_platform() -> Optional[str]:
+    """
+    Get container platform, Docker or Podman. The platform is probed only
+    once per process.
+
+    :return: Container platform, or `None` if it could not be determined.
+    :rtype: Optional[str]
+    """
+    out = subprocess_run_stdout(["docker", "--version"])
+    if not out:
+        return None
+    if out.startswith("podman"):
+        return "podman"
+    return "docker"
+
+
+@functools.cache
+def check_cache_export_supported() -> bool:
+    """
+    Check if Docker can export build cache to a registry. The support is
+    probed only once per process.
+
+    :return: `True` if the current buildx builder supports registry cache export.
+    :rtype: bool
+    """
+    out = subprocess_run_stdout(["docker", "buildx", "inspect"]) or ""
+    for line in out.splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() == "Driver" and value.strip() != "docker":
+            return True
+
+    # The default 'docker' driver supports cache export only with the
+    # containerd image store.
+    out = subprocess_run_stdout(["docker", "info", "--format", "{{.DriverStatus}}"])
+    return bool(out) and "io.containerd.snapshotter" in out
 
 
 def mount_param(
@@ -65,7 +170,7 @@ def mount_param(
     path: str,
     source_root: str,
     target_root: str,
-) -> str:
+) -> Optional[str]:
     """
     Get platform-specific mount parameter string.
 
@@ -77,18 +182,15 @@ def mount_param(
     :type source_root: str, optional
     :param target_root: Path destination root directory.
     :type target_root: str, optional
-    :return: Mount parameter string.
-    :rtype: str
+    :return: Mount parameter string, or `None` if the source path does not exist.
+    :rtype: Optional[str]
     """
     sp = join_path(source_root, path)
-    tp = join_path(target_root, path)
+    if not os.access(sp, os.F_OK):
+        return None
 
-    if not os.path.exists(sp):
-        return ""
-    if platform == "podman":
-        return f"--mount 'type=bind,src={sp},dst={tp},relabel=shared'"
-    else:
-        return f"--mount type=bind,source={sp},destination={tp}"
+    tp = join_path(target_root, path)
+    return MOUNT_PARAM_FORMATS[platform].format(src=sp, dst=tp)
 
 
 def create_shell_cmd(
@@ -102,28 +204,30 @@ def create_shell_cmd(
 
     :param platform: Container platform.
     :type platform: str
+    :param params: Command arguments, quoted as needed.
+    :type params: list[str], optional
     :return: Shell command.
     :rtype: str
     """
     p = [
-        f"{platform}",
+        platform,
         "run",
         "--rm",
         "--interactive",
         "--tty",
-        f"--hostname '{hostname}'",
+        "--hostname",
+        hostname,
     ]
     if platform == "podman":
         p.append("--userns=keep-id")
     else:
-        p.append(f"-u '{os.getuid()}:{os.getgid()}'")
+        p += ["-u", f"{UID}:{GID}"]
     if env_args:
-        for ea in env_args:
-            k, v = ea
-            p.append(f"--env {k}='{str(v)}'")
+        for k, v in env_args:
+            p += ["--env", f"{k}={v}"]
     if params:
-        p += params
-    return " ".join(p)
+        p.extend(params)
+    return shlex.join(p)
 
 
 def create_imgbuild_cmd(
@@ -131,36 +235,79 @@ def create_imgbuild_cmd(
     force: bool = False,
     build_args: Optional[list[tuple[str, Any]]] = None,
     params: Optional[list[str]] = None,
+    cache_tag: Optional[str] = None,
 ) -> str:
     """
     Get platform-specific image build command.
 
+    If `DOCKER_CACHE_REPO` is set, the build cache is imported from and
+    exported to that registry repository. With Docker the cache is tagged
+    `<cache_tag>-<DOCKER_CACHE_TAG>`, falling back to `<cache_tag>-latest`,
+    and only imported if the builder does not support cache export.
+
     :param platform: Container platform.
     :type platform: str
+    :param params: Command arguments, quoted as needed.
+    :type params: list[str], optional
+    :param cache_tag: Build cache tag prefix for the image.
+    :type cache_tag: str, optional
     :return: Image build command.
     :rtype: str
     """
-    p = [f"{platform}", "build"]
+    use_cache_repo = bool(DOCKER_CACHE_REPO and cache_tag)
+    if platform == "docker" and use_cache_repo:
+        # Registry cache requires BuildKit, load the result to the local images.
+        p = [platform, "buildx", "build", "--load"]
+    else:
+        p = [platform, "build"]
     if platform == "podman":
-        p += ["--format=docker"]
+        p.append("--format=docker")
+
+    if use_cache_repo:
+        if platform == "podman":
+            # Podman tags the cached layers by their content.
+            p += ["--layers", "--cache-from", DOCKER_CACHE_REPO]
+            p += ["--cache-to", DOCKER_CACHE_REPO]
+        else:
+            ref = f"{DOCKER_CACHE_REPO}:{cache_tag}-{DOCKER_CACHE_TAG}"
+            if DOCKER_CACHE_TAG != "latest":
+                p += [
+                    "--cache-from",
+                    f"type=registry,ref={DOCKER_CACHE_REPO}:{cache_tag}-latest",
+                ]
+            p += ["--cache-from", f"type=registry,ref={ref}"]
+            if check_cache_export_supported():
+                p += ["--cache-to", f"type=registry,ref={ref},mode=max"]
     if force:
-        p += ["--no-cache"]
+        p.append("--no-cache")
+    if platform == "docker" and CI:
+        # Plain log output instead of the interactive progress display.
+        p.append("--progress=plain")
     if build_args:
-        for ba in build_args:
-            k, v = ba
-            p.append(f"--build-arg {k}='{str(v)}'")
+        for k, v in build_args:
+            p += ["--build-arg", f"{k}={v}"]
     if params:
-        p += params
+        p.extend(params)
+
+    return shlex.join(p)
 
-    return " ".join(p)
+
+def split_params(params: Optional[list[str]]) -> list[str]:
+    """
+    Split command line parameters given to a task into command arguments.
+
+    :param params: Command line parameters.
+    :type params: list[str], optional
+    :return: Command arguments.
+    :rtype: list[str]
+    """
+    return [arg for param in params or [] for arg in shlex.split(param)]
 
 
-def check_image_exists(ctx: "Context", platform: str, image_name: str) -> Optional[str]:
+def check_image_exists(platform: str, image_name: str) -> Optional[str]:
     """
     Check if container image with specified name exists.
 
-    :param ctx: Invoke context.
-    :type ctx: Context
     :param platform: Container platform.
     :type platform: str
     :param image_name: Container image name.
@@ -168,78 +315,260 @@ def check_image_exists(ctx: "Context", platform: str, image_name: str) -> Option
     :return: Container image ID or `None` if not found.
     :rtype: Optional[str]
     """
-    cid = None
-    res = ctx.run(f"{platform} images -q {image_name}", hide=True, warn=True)
-    if res and not res.failed:
-        out = res.stdout.rstrip()
-        if out and out != "":
-            cid = out
-
-    if not cid:
-        log.info(f"No container image '{image_name}' found")
-        return None
-    return cid
+    img_info = check_image_info(platform, image_name)
+    return img_info[0] if img_info else None
 
 
-def check_image_date(
-    ctx: "Context", platform: str, image_name: str
-) -> Optional[datetime]:
+def parse_image_timestamp(stamp: str) -> datetime:
+    """
+    Parse container image creation timestamp.
+
+    The timestamp is either in RFC 3339 format (`2006-01-02T15:04:05.999999999Z`)
+    or a POSIX timestamp. RFC 3339 timestamps are normalized to the format
+    `datetime.fromisoformat` accepts before Python 3.11: UTC offset instead of
+    `Z` and exactly six fractional digits, as Go trims trailing zeros and
+    reports up to nanoseconds.
+
+    :param stamp: Timestamp string.
+    :type stamp: str
+    :return: Timestamp.
+    :rtype: datetime
+    """
+    if stamp.isdigit():
+        return datetime.fromtimestamp(int(stamp), timezone.utc)
+
+    if stamp.endswith("Z"):
+        stamp = f"{stamp[:-1]}+00:00"
+    dot = stamp.find(".")
+    if dot >= 0:
+        end = dot + 1
+        while end < len(stamp) and stamp[end].isdigit():
+            end += 1
+        frac = stamp[dot + 1 : end][:6].ljust(6, "0")
+        stamp = f"{stamp[:dot]}.{frac}{stamp[end:]}"
+    return datetime.fromisoformat(stamp)
+
+
+def check_image_info(
+    platform: str, image_name: str
+) -> Optional[tuple[str, datetime, str]]:
     """
-    Check the creation date of the container image with specified name.
+    Check the ID, creation date and build digest of the container image with
+    specified name.
+
+    Results are cached for the lifetime of the process; call
+    `invalidate_image_info()` after (re)building an image.
 
-    :param ctx: Invoke context.
-    :type ctx: Context
     :param platform: Container platform.
     :type platform: str
     :param image_name: Container image name.
     :type image_name: str
-    :return: Container build date or `None` if not found.
-    :rtype: Optional[datetime]
-    """
-    cid = None
-    res = ctx.run(f"{platform} images -q {image_name}", hide=True, warn=True)
-    if res and not res.failed:
-        out = res.stdout.rstrip()
-        if out and out != "":
-            cid = out
-
-    if not cid:
-        log.info(f"No container image '{image_name}' found")
-        return None
+    :return: Container image ID, build date and build digest, or `None` if not found.
+    :rtype: Optional[tuple[str, datetime, str]]
+    """
+    key = (platform, image_name)
+    if key in _IMAGE_INFO_CACHE:
+        return _IMAGE_INFO_CACHE[key]
 
-    res = ctx.run(
-        f"{platform} history --format '{{{{ .CreatedAt }}}}' {image_name}",
-        hide=True,
-        warn=True,
+    out = subprocess_run_stdout(
+        [
+            platform,
+            "image",
+            "inspect",
+            "--format",
+            IMAGE_INFO_FORMATS[platform],
+            image_name,
+        ]
     )
-    if res and not res.failed:
-        out = res.stdout.rstrip()
-        if out and out != "":
-            return datetime.strptime(out.splitlines()[0], "%Y-%m-%dT%H:%M:%S%z")
-    return None
+    if out:
+        cid, created, digest = out.split("|", 2)
+        img_info = (cid, parse_image_timestamp(created), digest)
+    else:
+        _log().info(f"No container image '{image_name}' found")
+        img_info = None
+
+    _IMAGE_INFO_CACHE[key] = img_info
+    return img_info
+
+
+def invalidate_image_info(platform: str, image_name: str) -> None:
+    """
+    Remove the cached info of the container image with specified name.
+
+    :param platform: Container platform.
+    :type platform: str
+    :param image_name: Container image name.
+    :type image_name: str
+    """
+    _IMAGE_INFO_CACHE.pop((platform, image_name), None)
+
+
+def probe_images(
+    platform: str, image_names: list[str]
+) -> dict[str, Optional[tuple[str, datetime, str]]]:
+    """
+    Check the ID, creation date and build digest of multiple container images
+    concurrently.
+
+    The results are stored in the `check_image_info` cache, so subsequent
+    checks of the same images do not query the container platform again.
+
+    :param platform: Container platform.
+    :type platform: str
+    :param image_names: Container image names.
+    :type image_names: list[str]
+    :return: Container image info for each image, or `None` if not found.
+    :rtype: dict[str, Optional[tuple[str, datetime, str]]]
+    """
+    uncached = [n for n in image_names if (platform, n) not in _IMAGE_INFO_CACHE]
+    if uncached:
+        with ThreadPoolExecutor(max_workers=min(8, len(uncached))) as ex:
+            list(ex.map(lambda n: check_image_info(platform, n), uncached))
+
+    return {n: _IMAGE_INFO_CACHE[(platform, n)] for n in image_names}
+
+
+def get_imgbuild_digest(dockerfile: str, build_args: list[tuple[str, Any]]) -> str:
+    """
+    Get digest of the container image build inputs: the Dockerfile and build arguments.
+
+    :param dockerfile: Dockerfile path, relative to the Dockerfile directory.
+    :type dockerfile: str
+    :param build_args: Image build arguments.
+    :type build_args: list[tuple[str, Any]]
+    :return: Hex digest of the image build inputs.
+    :rtype: str
+    """
+    with open(join_path(DOCKERFILE_DIR, dockerfile), "rb") as f:
+        h = hashlib.sha256(f.read())
+    for k, v in sorted((k, str(v)) for k, v in build_args):
+        h.update(f"\0{k}={v}".encode())
+    return h.hexdigest()
 
 
-def get_image_timedelta(ctx: "Context", platform: str, image_name: str) -> timedelta:
+def check_image_rebuild(
+    platform: str,
+    image_name: str,
+    max_days: int,
+    force: bool,
+    digest: Optional[str] = None,
+) -> tuple[bool, bool]:
     """
-    Get timedelta of the container image creation date compared to current date.
+    Check if the container image with specified name needs to be (re)built,
+    and if the build must bypass the layer cache.
+
+    The image is rebuilt if it does not exist or was built from different
+    inputs than specified by `digest`. An image built from the same inputs is
+    kept regardless of its age; images without a build digest are rebuilt
+    when they are too old. Forced and age-triggered
+    rebuilds bypass the layer cache, as a cached build would not refresh
+    anything.
 
-    :param ctx: Invoke context.
-    :type ctx: Context
     :param platform: Container platform.
     :type platform: str
     :param image_name: Container image name.
     :type image_name: str
-    :return: Timedelta to container image creation date, or empty timedelta if not found.
-    :rtype: timedelta
+    :param max_days: Rebuild the image if it is more than N days old.
+    :type max_days: int
+    :param force: Force the image rebuild.
+    :type force: bool
+    :param digest: Digest of the image build inputs.
+    :type digest: str, optional
+    :return: Whether the image needs to be (re)built, and whether without cache.
+    :rtype: tuple[bool, bool]
     """
-    dt = check_image_date(ctx, platform, image_name)
-    if dt:
-        return datetime.now(dt.tzinfo) - dt
-    return timedelta()
+    if force:
+        _log().info(f"Forcing (re)build of image: '{image_name}'")
+        return True, True
+
+    img_info = check_image_info(platform, image_name)
+    if not img_info:
+        _log().info(f"Image '{image_name}' does not exist, building.")
+        return True, False
+    _, created, img_digest = img_info
+    if digest and img_digest:
+        if img_digest == digest:
+            _log().info(f"Image '{image_name}' build inputs are unchanged, skipping.")
+            return False, False
+        _log().info(f"Image '{image_name}' build inputs have changed, rebuilding.")
+        return True, False
+    if (datetime.now(created.tzinfo) - created).days > max_days:
+        _log().info(
+            f"Image '{image_name}' is more than {max_days} days old, rebuilding."
+        )
+        return True, True
+
+    _log().info(
+        f"Image '{image_name}' exists and is less than {max_days} days old, skipping."
+    )
+    return False, False
+
+
+def get_build_digest(conf: "TargetConfig", image_id: str) -> str:
+    """
+    Get digest of the build inputs: target configuration, imagebuilder image
+    and the overlay files.
+
+    Overlay files are hashed by relative path, size and modification time.
+
+    :param conf: Target configuration.
+    :type conf: TargetConfig
+    :param image_id: Imagebuilder container image ID.
+    :type image_id: str
+    :return: Hex digest of the build inputs.
+    :rtype: str
+    """
+    h = hashlib.blake2b(
+        repr(
+            (
+                conf.profile,
+                conf.release_str,
+                conf.target,
+                conf.subtarget,
+                conf.packages,
+                conf.disabled_services,
+                image_id,
+            )
+        ).encode()
+    )
+
+    for root, dirs, files in os.walk(OVERLAY_DIR):
+        dirs.sort()
+        for name in sorted(files):
+            path = join_path(root, name)
+            st = os.stat(path)
+            h.update(
+                f"{os.path.relpath(path, OVERLAY_DIR)}|{st.st_size}|{st.st_mtime_ns}\n".encode()
+            )
+
+    return h.hexdigest()
+
+
+def check_build_current(output_dir: str, profile: str, digest: str) -> bool:
+    """
+    Check if the output directory has images built from the same inputs.
+
+    :param output_dir: Output directory path.
+    :type output_dir: str
+    :param profile: Target profile.
+    :type profile: str
+    :param digest: Digest of the current build inputs.
+    :type digest: str
+    :return: `True` if the build digest matches and output images exist.
+    :rtype: bool
+    """
+    try:
+        with open(join_path(output_dir, BUILD_DIGEST_FILE), "r") as f:
+            if f.read().strip() != digest:
+                return False
+    except FileNotFoundError:
+        return False
+
+    return bool(glob.glob(join_path(output_dir, f"openwrt-*-{profile}-*")))
 
 
 def imgname_to_hostname(imgname: str) -> str:
-    return re.sub(r"[\\/\._-]", "-", imgname)
+    return imgname.translate(HOSTNAME_TRANS)
 
 
 ###############################################################################
@@ -252,24 +581,18 @@ def check_platform(ctx: "Context") -> None:
     some command parameters differ even if they are mostly
     compatible.
     """
+    cfg = ctx.config
+    if "platform" in cfg:
+        return
 
-    res = ctx.run("docker --version", hide=True)
-    if not res or res.failed:
+    platform = get_container_platform()
+    if not platform:
         raise Exit(
             "Could not determine container platform (Docker/Podman) - cannot continue!"
         )
 
-    out = res.stdout.rstrip()
-    if out.startswith("podman"):
-        platform = "podman"
-    else:
-        platform = "docker"
-
-    log.info(f"Container platform: {platform}")
-
-    cfg = ctx.config
-    if "platform" not in cfg:
-        cfg.platform = platform
+    _log().info(f"Container platform: {platform}")
+    cfg.platform = platform
 
 
 @task(
@@ -296,38 +619,32 @@ def baseimage(
     platform = ctx.config.platform
     imgname = OPENWRT_BASE_IMAGE
 
-    do_build = False
-    img_id = check_image_exists(ctx, platform, imgname)
-    timedelta = get_image_timedelta(ctx, platform, imgname)
-
-    if force:
-        log.info(f"Forcing (re)build of image: '{imgname}'")
-        do_build = True
-    elif not img_id:
-        log.info(f"Image '{imgname}' does not exist, building.")
-        do_build = True
-    elif timedelta.days > max_days:
-        log.info(f"Image '{imgname}' is more than {max_days} days old, rebuilding.")
-    else:
-        log.info(
-            f"Image '{imgname}' exists and is less than {max_days} days old, skipping."
-        )
+    build_args = [("REGISTRY", REGISTRY), ("BASE_IMAGE", ROOT_IMAGE)]
+    digest = get_imgbuild_digest(dockerfile, build_args)
+    rebuild, no_cache = check_image_rebuild(platform, imgname, max_days, force, digest)
+    if not rebuild:
+        return
 
-    if do_build:
-        command = create_imgbuild_cmd(
-            platform=platform,
-            force=force,
-            build_args=[("REGISTRY", REGISTRY), ("BASE_IMAGE", ROOT_IMAGE)],
-            params=[
-                f"--tag '{imgname}'",
-                f"--file '{dockerfile}'",
-            ]
-            + (params or []),
-        )
+    command = create_imgbuild_cmd(
+        platform=platform,
+        force=no_cache,
+        build_args=build_args,
+        params=[
+            "--tag",
+            imgname,
+            "--file",
+            dockerfile,
+            "--label",
+            f"{BUILD_DIGEST_LABEL}={digest}",
+            *split_params(params),
+        ],
+        cache_tag="openwrt-base",
+    )
 
-        with ctx.cd(DOCKERFILE_DIR):
-            log.info(f"Build command: {command}")
-            ctx.run(command, pty=True)
+    with ctx.cd(DOCKERFILE_DIR):
+        _log().info(f"Build command: {command}")
+        ctx.run(command, pty=True, env=IMGBUILD_ENV[platform])
+    invalidate_image_info(platform, imgname)
 
 
 @task(pre=[check_platform])
@@ -335,17 +652,18 @@ def check_baseimage(ctx: "Context") -> None:
     """
     Check if the base image exists, and rebuild if necessary.
     """
-    if not check_image_exists(ctx, ctx.config.platform, OPENWRT_BASE_IMAGE):
-        log.info(f"Image '{OPENWRT_BASE_IMAGE}' does not exist, building.")
+    if not check_image_info(ctx.config.platform, OPENWRT_BASE_IMAGE):
+        _log().info(f"Image '{OPENWRT_BASE_IMAGE}' does not exist, building.")
         baseimage(ctx, force=True)
 
 
 @task(
-    pre=[check_platform, check_baseimage],
+    pre=[check_platform],
     iterable=["params"],
     optional=["config", "dockerfile", "params"],
     help={
         "config": f"Name of the config file to use (default '{DEFAULT_CONF}').",
+        "workdir": f"Working directory containing the config file (default '{PROJECT_ROOT}').",
         "dockerfile": "Optional alternative Dockerfile to use.",
         "max_days": f"Rebuild the image if the previous is more than N days old (default {DEFAULT_MAX_AGE}).",
         "force": "Force container image rebuild (default 'False').",
@@ -355,6 +673,7 @@ def check_baseimage(ctx: "Context") -> None:
 def imagebuilder(
     ctx: "Context",
     config: str = DEFAULT_CONF,
+    workdir: str = PROJECT_ROOT,
     dockerfile: Optional[str] = None,
     max_days: int = DEFAULT_MAX_AGE,
     force: bool = False,
@@ -365,50 +684,52 @@ def imagebuilder(
     """
     platform = ctx.config.platform
 
-    do_build = False
-    conf = get_target_config(join_path(os.getcwd(), config))
+    conf = get_target_config(join_path(workdir, config))
     imgname = conf.image_name()
     dockerfile = dockerfile if dockerfile else IMAGEBUILDER_DOCKERFILE
-    img_id = check_image_exists(ctx, platform, imgname)
-    timedelta = get_image_timedelta(ctx, platform, imgname)
 
-    if force:
-        log.info(f"Forcing (re)build of image: '{imgname}'")
-        do_build = True
-    elif not img_id:
-        log.info(f"Image '{imgname}' does not exist, building.")
-        do_build = True
-    elif timedelta.days > max_days:
-        log.info(f"Image '{imgname}' is more than {max_days} days old, rebuilding.")
-    else:
-        log.info(
-            f"Image '{imgname}' exists and is less than {max_days} days old, skipping."
-        )
-
-    if do_build:
-        command = create_imgbuild_cmd(
-            platform,
-            force,
-            [
-                ("REGISTRY", "localhost"),
-                ("BASE_IMAGE", OPENWRT_BASE_IMAGE),
-                ("BUILDER_URL", conf.imagebuilder_url),
-                ("BUILDER_WORKDIR_ROOT", IMAGEBUILDER_WORKDIR_ROOT),
-                ("BUILDER_WORKDIR", IMAGEBUILDER_WORKDIR),
-                ("BUILDER_USER", IMAGEBUILDER_USER),
-                ("BUILDER_UID", os.getuid()),
-                ("BUILDER_GID", os.getgid()),
-            ],
-            [
-                f"--tag '{imgname}'",
-                f"--file '{dockerfile}'",
-            ]
-            + (params or []),
-        )
+    # Check base and target images at once, the results are cached
+    # for the checks below. A forced rebuild does not need the target image.
+    probe_images(
+        platform, [OPENWRT_BASE_IMAGE] if force else [OPENWRT_BASE_IMAGE, imgname]
+    )
+    check_baseimage(ctx)
+
+    build_args = [
+        ("REGISTRY", "localhost"),
+        ("BASE_IMAGE", OPENWRT_BASE_IMAGE),
+        ("BUILDER_URL", conf.imagebuilder_url),
+        ("BUILDER_WORKDIR_ROOT", IMAGEBUILDER_WORKDIR_ROOT),
+        ("BUILDER_WORKDIR", IMAGEBUILDER_WORKDIR),
+        ("BUILDER_USER", IMAGEBUILDER_USER),
+        ("BUILDER_UID", UID),
+        ("BUILDER_GID", GID),
+    ]
+    digest = get_imgbuild_digest(dockerfile, build_args)
+    rebuild, no_cache = check_image_rebuild(platform, imgname, max_days, force, digest)
+    if not rebuild:
+        return
+
+    command = create_imgbuild_cmd(
+        platform,
+        no_cache,
+        build_args,
+        [
+            "--tag",
+            imgname,
+            "--file",
+            dockerfile,
+            "--label",
+            f"{BUILD_DIGEST_LABEL}={digest}",
+            *split_params(params),
+        ],
+        imgname.replace("/", "-"),
+    )
 
-        with ctx.cd(DOCKERFILE_DIR):
-            log.info(f"Build command: {command}")
-            ctx.run(command, pty=True)
+    with ctx.cd(DOCKERFILE_DIR):
+        _log().info(f"Build command: {command}")
+        ctx.run(command, pty=True, env=IMGBUILD_ENV[platform])
+    invalidate_image_info(platform, imgname)
 
 
 @task(
@@ -434,17 +755,17 @@ def shell(
     If `base` is `False`, the `config` parameter is required.
     """
     platform = ctx.config.platform
+    env_args = [("PLATFORM", platform), ("UID", UID), ("GID", GID)]
 
     if base:
         imgname = OPENWRT_BASE_IMAGE
-        env_args = [("PLATFORM", platform), ("UID", os.getuid()), ("GID", os.getgid())]
         mounts = []
     else:
         conf = get_target_config(join_path(workdir, config))
         imgname = conf.image_name()
-        img_id = check_image_exists(ctx, platform, imgname)
+        img_id = check_image_exists(platform, imgname)
         if not img_id:
-            log.info(f"Image '{imgname}' does not exist.")
+            _log().info(f"Image '{imgname}' does not exist.")
             raise Exit(f"Image '{imgname}' does not exist.")
 
         output_dir = f"output-{conf.profile}"
@@ -464,30 +785,25 @@ def shell(
             ),
             mount_param(
                 platform,
-                OVERLAY_DIR,
-                workdir,
+                OVERLAY_DIR_NAME,
+                PROJECT_ROOT,
                 IMAGEBUILDER_WORKDIR_ROOT,
             ),
         ]
 
-        env_args = [
-            ("PLATFORM", platform),
-            ("UID", os.getuid()),
-            ("GID", os.getgid()),
+        env_args += [
             ("PROFILE", conf.profile),
-            ("BIN_DIR", f"{join_path(IMAGEBUILDER_WORKDIR_ROOT, output_dir)}"),
+            ("BIN_DIR", join_path(IMAGEBUILDER_WORKDIR_ROOT, output_dir)),
         ]
         # env_args += [
         # ("PACKAGES", f"{' '.join(conf.packages)}"),
         # ("DISABLED_SERVICES", f"{' '.join(conf.disabled_services)}"),
         # ]
 
-    p = mounts
-    p.append(f"{imgname}")
-    if not command:
-        command = "bash"
-    else:
-        p.append(f"{command}")
+    p = [m for m in mounts if m is not None]
+    p.append(imgname)
+    if command:
+        p += ["bash", "-c", command]
 
     command = create_shell_cmd(
         platform=platform,
@@ -496,12 +812,12 @@ def shell(
         params=p,
     )
 
-    log.info(f"Shell command: {command}")
+    _log().info(f"Shell command: {command}")
     ctx.run(command, pty=True)
 
 
 @task(
-    pre=[check_platform, check_baseimage],
+    pre=[check_platform],
     help={
         "config": f"Name of the config file to use (default '{DEFAULT_CONF}').",
         "workdir": f"Working directory to mount in the container (default '{PROJECT_ROOT}').",
@@ -519,58 +835,77 @@ def build(
     """
     conf = get_target_config(join_path(workdir, config))
 
-    log.info(
+    _log().info(
         f"Target configuration: \n"
         f"\t\t\t\tOPENWRT_PROFILE -> {conf.profile}\n"
-        f"\t\t\t\tOPENWRT_RELEASE -> {conf.release}\n"
+        f"\t\t\t\tOPENWRT_RELEASE -> {conf.release_str}\n"
         f"\t\t\t\tOPENWRT_TARGET -> {conf.target}\n"
         f"\t\t\t\tOPENWRT_SUBTARGET -> {conf.subtarget}\n"
     )
 
-    # Build image if needed
-    imagebuilder(ctx, config=config, force=force)
+    # Build images if needed
+    imagebuilder(ctx, config=config, workdir=workdir, force=force)
 
     # Create output directory if needed
     output_dir = f"output-{conf.profile}"
-    check_create_dir(join_path(workdir, output_dir))
+    output_path = join_path(workdir, output_dir)
+    check_create_dir(output_path)
+
+    # Skip the build if the outputs were built from the same inputs
+    img_info = check_image_info(ctx.config.platform, conf.image_name())
+    digest = get_build_digest(conf, img_info[0] if img_info else "")
+    digest_path = join_path(output_path, BUILD_DIGEST_FILE)
+    if not force and check_build_current(output_path, conf.profile, digest):
+        _log().info(f"Output in '{output_path}' is up-to-date, skipping.")
+        return
+    try:
+        os.remove(digest_path)
+    except FileNotFoundError:
+        pass
 
     # Generate command
     cmd = [
         "make",
-        f"-C '{IMAGEBUILDER_WORKDIR}'",
+        "-C",
+        IMAGEBUILDER_WORKDIR,
         "image",
-        f"PROFILE='{conf.profile}'",
-        f"PACKAGES='{' '.join(conf.packages)}'",
-        f"DISABLED_SERVICES='{' '.join(conf.disabled_services)}'",
-        f"BIN_DIR='{join_path(IMAGEBUILDER_WORKDIR_ROOT, output_dir)}'",
+        f"PROFILE={conf.profile}",
+        f"PACKAGES={' '.join(conf.packages)}",
+        f"DISABLED_SERVICES={' '.join(conf.disabled_services)}",
+        f"BIN_DIR={join_path(IMAGEBUILDER_WORKDIR_ROOT, output_dir)}",
     ]
 
-    if os.path.exists(OVERLAY_DIR):
-        cmd.append(f"FILES='{join_path(IMAGEBUILDER_WORKDIR_ROOT, 'overlay')}'")
+    if os.access(OVERLAY_DIR, os.F_OK):
+        cmd.append(f"FILES={IMAGEBUILDER_OVERLAY_DIR}")
 
     # Build the image
-    command = " ".join(cmd)
-    log.info(f"Build command: {command}")
+    command = shlex.join(cmd)
+    _log().info(f"Build command: {command}")
     shell(ctx, config=config, command=command, workdir=workdir)
 
+    with open(digest_path, "w") as f:
+        f.write(f"{digest}\n")
+
 
 @task(
     pre=[check_platform],
     optional=["config"],
     help={
         "config": f"Name of the config file to use (default '{DEFAULT_CONF}').",
+        "workdir": f"Working directory to mount in the container (default '{PROJECT_ROOT}').",
     },
 )
 def info(
     ctx: "Context",
     config: str = DEFAULT_CONF,
+    workdir: str = PROJECT_ROOT,
 ):
     """
     Show imagebuilder info.
     """
-    command = f"make -C '{IMAGEBUILDER_WORKDIR}' info"
-    # log.info(f"Shell command: {command}")
-    shell(ctx, config=config, command=command)
+    command = shlex.join(["make", "-C", IMAGEBUILDER_WORKDIR, "info"])
+    # _log().info(f"Shell command: {command}")
+    shell(ctx, config=config, command=command, workdir=workdir)
 
 
 @task(
@@ -591,11 +926,14 @@ def clean(
     """
     conf = get_target_config(join_path(workdir, config))
 
-    command = f"make -C '{IMAGEBUILDER_WORKDIR}' clean"
-    # log.info(f"Shell command: {command}")
-    shell(ctx, config=config, command=command)
+    command = shlex.join(["make", "-C", IMAGEBUILDER_WORKDIR, "clean"])
+    # _log().info(f"Shell command: {command}")
+    shell(ctx, config=config, command=command, workdir=workdir)
 
-    ctx.run(f"rm -rf {join_path(workdir, f'output-{conf.profile}')}", pty=True)
+    output_path = join_path(workdir, f"output-{conf.profile}")
+    if os.path.isdir(output_path):
+        _log().info(f"Removing output directory '{output_path}'")
+        shutil.rmtree(output_path)
 
 
 # Add all tasks to the namespace
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from utils import _iter_logical_lines
+
+
+class IterLogicalLinesTest(unittest.TestCase):
+    def test_hash_in_quoted_value(self):
+        lines = ['KEY="a#b"  # comment\n', "NEXT=1\n"]
+        self.assertEqual(list(_iter_logical_lines(lines)), ['KEY="a#b"', "NEXT=1"])
+
+    def test_hash_in_multiline_quoted_value(self):
+        lines = ["KEY='a\n", "#b'\n", "NEXT=1 # comment\n"]
+        self.assertEqual(list(_iter_logical_lines(lines)), ["KEY='a #b'", "NEXT=1"])
+
+    def test_apostrophe_in_double_quoted_value(self):
+        lines = ['KEY="it\'s"\n', "NEXT=1\n"]
+        self.assertEqual(list(_iter_logical_lines(lines)), ['KEY="it\'s"', "NEXT=1"])
+
+    def test_comments_and_continuation(self):
+        lines = ["# comment\n", "KEY=a\\\n", "  b # comment\n", "\n", "NEXT=1\n"]
+        self.assertEqual(list(_iter_logical_lines(lines)), ["KEY=a b", "NEXT=1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
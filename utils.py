@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+import functools
 import os
 import re
+import subprocess
+from collections.abc import Iterable, Iterator
+from typing import TYPE_CHECKING, Optional
 
 import attrs
-from semver import VersionInfo, parse_version_info
+
+if TYPE_CHECKING:
+    from semver import Version
 
 IMAGEBUILDER_BASE_URL = r"https://downloads.openwrt.org/releases/{}/targets/{}/{}/openwrt-imagebuilder-{}-{}-{}.Linux-x86_64.tar.{}"
 
@@ -14,6 +20,9 @@ REQUIRED_CONFIG_KEYS = [
     "OPENWRT_SUBTARGET",
     "OPENWRT_PACKAGES",
 ]
+_REQUIRED_CONFIG_KEYS_SET = frozenset(REQUIRED_CONFIG_KEYS)
+
+_WS_RE = re.compile(r"\s\s+")
 
 
 def join_path(path1: str, path2: str) -> str:
@@ -25,26 +34,81 @@ def strip_whitespace(value: str) -> str:
     value = value.strip()
 
     # Then, replace multiple whitespaces within the string
-    # with a single whitespace.
-    value = re.sub(r"\s\s+", " ", value)
+    # with a single whitespace, if there are any.
+    if "  " not in value and "\t" not in value:
+        return value
+    return _WS_RE.sub(" ", value)
+
+
+def _is_valid_key(key: str) -> bool:
+    # Config keys consist of ASCII word characters, dashes and dots.
+    return (
+        key.isascii()
+        and key.replace("_", "").replace("-", "").replace(".", "").isalnum()
+    )
+
+
+def _iter_logical_lines(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Iterate logical lines of configuration file, with comments removed.
+
+    Bash-style multiline strings, either continued with a trailing backwards
+    slash ('\\') or by an unterminated quoted string, are joined into a single
+    logical line.
 
-    return value
+    :param lines: Physical lines of the configuration file, e.g. an open file.
+    :type lines: Iterable[str]
+    :return: Iterator over non-empty logical lines.
+    :rtype: Iterator[str]
+    """
+    parts: list[str] = []
+    # Quote character of an unterminated quoted string, if any.
+    quote = ""
+    for raw in lines:
+        # Remove comment lines starting with '#', or comments at the end of the
+        # line. A '#' inside a quoted string is part of the value. Only the
+        # opening quote character terminates the quoted string, e.g. the
+        # apostrophe in "it's" does not.
+        for i, ch in enumerate(raw):
+            if ch == quote:
+                quote = ""
+            elif quote:
+                continue
+            elif ch in "'\"":
+                quote = ch
+            elif ch == "#":
+                raw = raw[:i]
+                break
+        raw = raw.strip()
+
+        continued = raw.endswith("\\")
+        if continued:
+            raw = raw.rstrip("\\")
+        if raw:
+            parts.append(raw)
+        if continued or quote or not parts:
+            continue
+
+        yield " ".join(parts)
+        parts.clear()
+
+    # Unterminated continuation at the end of file.
+    if parts:
+        yield " ".join(parts)
 
 
 @attrs.define(frozen=True)
 class TargetConfig:
     profile: str
-    release: VersionInfo
+    release: "Version"
+    # Release as written in the config, e.g. '23.05.3', used in download URLs.
+    release_str: str
     target: str
     subtarget: str
-    packages: list[str] = attrs.field(converter=list)
-    disabled_services: list[str] = attrs.field(converter=list)
-
-    @property
-    def release_str(self) -> str:
-        return f"{self.release.major}.{self.release.minor}.{self.release.patch}"
+    packages: tuple[str, ...] = attrs.field(converter=tuple)
+    disabled_services: tuple[str, ...] = attrs.field(converter=tuple)
 
-    @property
+    @functools.cached_property
     def imagebuilder_url(self) -> str:
         if self.release.major >= 24:
             ext = "zst"
@@ -62,78 +126,71 @@ class TargetConfig:
         )
         return url
 
-    def image_name(self, basename: str = "imagebuilder") -> str:
-        return f"openwrt/{basename}-{self.release_str}-{self.target}-{self.subtarget}"
-
+    @functools.cached_property
+    def _image_name_suffix(self) -> str:
+        return f"-{self.release_str}-{self.target}-{self.subtarget}"
 
-# Handle possible multiline strings which continue with '\' (Bash-style).
-# contents = re.sub(r"(\\[\r?\n|\r]\s+)", "", contents)
-# Grab text between quotes containing newlines.
-# (?m)(?:[\'\"])([^\'\"]+)(?:[\'\"])
-# (?m)(?:[\w_\-\.]+)=(?:[\'\"])(?:[\w\d\s\\_\-\.]*)(?<=[\w\s])([\\\s]*\r?\n)
-# ^(?<!#)(?P<key>[\w_\-\.]+)=(?:[\'\"])?(?P<value>[\w\s\\_\-\.]*)(?:[\'\"])?$
-# (?=\r?\n|\r)
-# re.sub(r"(?m)(^#.*[\r?\n|\r])", "", contents)
-# ^[--]{1}.+(?=\r?\n|\r)
+    def image_name(self, basename: str = "imagebuilder") -> str:
+        return f"openwrt/{basename}{self._image_name_suffix}"
 
 
 def get_target_config(config_path: str) -> TargetConfig:
     """
     Parse target configuration file.
 
+    The parsed configuration is cached by absolute path and modification time,
+    so the file is only parsed again if it has been modified.
+
     :param config_path: Path to target configuration file.
     :type config_path: str
+    :raises RuntimeError: If the config file does not exist.
     :raises RuntimeError: If the config does not contain all required keys.
     :raises RuntimeError: If the config has invalid values for required keys.
+    :raises RuntimeError: If the config release is not a valid version.
     :return: Target configuration.
     :rtype: TargetConfig
     """
-    if not (config_path or os.path.exists(config_path)):
-        raise RuntimeError("Config file not found")
+    try:
+        mtime = os.stat(config_path).st_mtime_ns
+    except FileNotFoundError:
+        raise RuntimeError(f"Config file {config_path} not found") from None
+
+    return _get_target_config_cached(os.path.abspath(config_path), mtime)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_target_config_cached(config_path: str, mtime: int) -> TargetConfig:
+    return _parse_target_config(config_path)
+
+
+def _parse_target_config(config_path: str) -> TargetConfig:
+    from semver import Version
 
     c = {}
 
     try:
         with open(config_path, "r") as f:
-            contents = f.read()
-
-            # Remove comment lines starting with '#', or comments at the end of the line
-            contents = re.sub(r"(^#.*[\r?\n])", "", contents, flags=re.MULTILINE)
-            contents = re.sub(r"(#.*)(?=\r?\n)", "", contents)
-
-            # For easier parsing, remove newlines, backwards slashes ('\') and extra spaces
-            # within quoted strings. This handles Bash-style multiline strings into more
-            # tolerable form.
-            # contents = re.sub(r"(?<=[\w\s])([\\\s]*\r?\n)", " ", contents)
-            contents = re.sub(
-                r"(?:[\"\'])[^\"\']+(?:[\"\'])",
-                lambda m: re.sub(r"[\\\r\n\s]+", " ", m.group(0)),
-                contents,
-            )
-
-            # The actual processing, match key and value separated with '=' in named groups.
-            pattern = re.compile(
-                r"(?P<key>[\w\-\.]+)=(?:[\'\"])?(?P<value>[\w\s\-\.]*)(?:[\'\"])?"
-            )
-            for line in contents.splitlines():
-                if match := pattern.match(line):
-                    k = strip_whitespace(match["key"])
-                    v = strip_whitespace(match["value"])
-                    c[k] = v
+            # The actual processing, split key and value separated with '='.
+            for line in _iter_logical_lines(f):
+                eq = line.find("=")
+                if eq > 0:
+                    k = line[:eq]
+                    if _is_valid_key(k):
+                        c[k] = strip_whitespace(line[eq + 1 :].strip("'\""))
     except FileNotFoundError:
-        pass
+        raise RuntimeError(f"Config file {config_path} not found") from None
 
     # Validate that required config keys are present,
     # and that there are values for each key.
-    if not all(k in c.keys() for k in REQUIRED_CONFIG_KEYS):
+    if not _REQUIRED_CONFIG_KEYS_SET.issubset(c):
+        missing = [k for k in REQUIRED_CONFIG_KEYS if k not in c]
         raise RuntimeError(
-            f"Config file {config_path} does not contain all required keys: {REQUIRED_CONFIG_KEYS}"
+            f"Config file {config_path} does not contain all required keys, missing: {missing}"
         )
-    for k in c.keys():
-        if k in REQUIRED_CONFIG_KEYS:
-            v = c.get(k, None)
-            if not v or (isinstance(v, str) and v == ""):
-                raise RuntimeError(f"Config key {k} has invalid value: {v}")
+    for k in REQUIRED_CONFIG_KEYS:
+        v = c[k]
+        if not v:
+            raise RuntimeError(f"Config key {k} has invalid value: {v}")
 
     # Maybe not needed?
     # Separate packages to those being installed and those
@@ -142,8 +199,19 @@ def get_target_config(config_path: str) -> TargetConfig:
     # https://www.compart.com/en/unicode/category/Pd
     # ^[\u002D\u2010].+$
 
+    # OpenWRT zero-pads the minor version (e.g. '23.05.3'), which semver
+    # does not allow, so normalize the numeric part before parsing.
+    release_str = c.get("OPENWRT_RELEASE")
+    core, sep, suffix = release_str.partition("-")
+    try:
+        core = ".".join(str(int(n)) for n in core.split("."))
+        release = Version.parse(f"{core}{sep}{suffix}")
+    except ValueError:
+        raise RuntimeError(
+            f"Config key OPENWRT_RELEASE is not a valid release version: {release_str}"
+        ) from None
+
     profile = c.get("OPENWRT_PROFILE")
-    release = parse_version_info(c.get("OPENWRT_RELEASE"))
     target = c.get("OPENWRT_TARGET")
     subtarget = c.get("OPENWRT_SUBTARGET")
     packages = c.get("OPENWRT_PACKAGES").split()
@@ -156,6 +224,7 @@ def get_target_config(config_path: str) -> TargetConfig:
     return TargetConfig(
         profile=profile,
         release=release,
+        release_str=release_str,
         target=target,
         subtarget=subtarget,
         packages=packages,
@@ -163,12 +232,24 @@ def get_target_config(config_path: str) -> TargetConfig:
     )
 
 
-# def _subprocess_run_stdout(command: str) -> Optional[str]:
-#    result = subprocess.run(command, shell=True, capture_output=True)
-#    if result.returncode != 0:
-#        return None
-#    return result.stdout.decode().rstrip()
-#
+def subprocess_run_stdout(argv: list[str]) -> Optional[str]:
+    """
+    Run a command directly, without a shell, and return its output.
+
+    :param argv: Command and its arguments.
+    :type argv: list[str]
+    :return: Command output with trailing whitespace removed, or `None` if the command failed.
+    :rtype: Optional[str]
+    """
+    try:
+        result = subprocess.run(argv, capture_output=True, text=True)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.rstrip()
+
+
 # def timedelta_to_dhms(td: timedelta) -> tuple[int, int, int, float]:
 #    """
 #    Convert `datetime.timedelta` to days, hours, minutes and seconds.